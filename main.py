@@ -1,189 +1,464 @@
 import os
-import subprocess
 import asyncio
+import atexit
+import asyncio.subprocess
+import collections
+import concurrent.futures
 import functools
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from pathlib import Path
 import logging
-import urllib.request
-import urllib.error
+import logging.handlers
+import multiprocessing
+import queue
+import random
+import re
+import tempfile
 import json
 import difflib
+import hashlib
+import aiohttp
 from pyrogram import Client
 from pyrogram.errors import FloodWait
+from apscheduler.executors.asyncio import AsyncIOExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 import signal
 import sys
 from dotenv import load_dotenv
 
-load_dotenv()
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Налаштування логування: запис у файл і консоль виконує окремий потік QueueListener.
+# Викликається лише з __main__: процеси diff_pool імпортують модуль заново
+# і не повинні відкривати backup.log чи запускати потоки.
+def setup_logging():
+    log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_file_handler = logging.handlers.RotatingFileHandler(
+        'backup.log',
+        maxBytes=10_000_000,
+        backupCount=5,
+        encoding='utf-8'
+    )
+    log_stream_handler = logging.StreamHandler()
+    for handler in (log_file_handler, log_stream_handler):
+        handler.setFormatter(log_formatter)
+
+    log_queue = queue.Queue(-1)
+    log_listener = logging.handlers.QueueListener(
+        log_queue,
+        log_file_handler,
+        log_stream_handler,
+        respect_handler_level=True
+    )
+    # Форматування робить лише QueueListener, тож QueueHandler передає сам текст
+    log_queue_handler = logging.handlers.QueueHandler(log_queue)
+    log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(
+        level=logging.INFO,
+        handlers=[log_queue_handler]
+    )
+    log_listener.start()
+    # Зупинка через atexit, щоб черга дописалась і при sys.exit до/поза main()
+    atexit.register(log_listener.stop)
+
 
-# Налаштування логування
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('backup.log'),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
 # Конфігурація з environment variables
-MONGODB_URI = os.getenv('MONGODB_URI')
-BACKUP_DIR = os.getenv('BACKUP_DIR', './backups')
-TELEGRAM_API_ID = os.getenv('TELEGRAM_API_ID')
-TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH')
-CONTROL_API_URL = os.getenv(
-    'CONTROL_API_URL',
-    'https://control-api.undresstool.fun/v1/bots/?page=1&page_size=100&show_tokens=true'
-)
-CONTROL_API_CONTAINERS_URL = os.getenv(
-    'CONTROL_API_CONTAINERS_URL',
-    'https://control-api.undresstool.fun/v1/system/containers/small'
-)
-CONTROL_API_KEY = os.getenv('CONTROL_API_KEY')
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Налаштування сервісу з environment variables."""
+    mongodb_uri: str
+    telegram_api_id: str
+    telegram_api_hash: str
+    telegram_chat_id: int
+    backup_dir: str
+    backup_interval_minutes: int
+    keep_local_backups: int
+    mongodump_parallel: int
+    mongodump_exclude: tuple
+    mongodump_read_preference: str | None
+    session_name: str
+    telegram_max_transmissions: int
+    control_api_url: str
+    control_api_containers_url: str
+    control_api_key: str | None
+    bot_check_interval_minutes: int
+    bot_check_start_delay_seconds: int
+    pose_check_interval_minutes: int
+    pose_check_start_delay_seconds: int
+    pose_data_dir: str
+    pose_api_base_url: str
+    pose_api_token: str | None
+
+
+def _env_int(name: str, default: int) -> int:
+    """Зчитує ціле число з env, завершує процес при невалідному значенні."""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.error(f"Змінна {name} ('{value}') не є валідним числом! Перевірте .env файл.")
+        sys.exit(1)
 
-try:
-    TELEGRAM_CHAT_ID = int(os.getenv('TELEGRAM_CHAT_ID'))
-except (ValueError, TypeError):
-    logger.error(f"Змінна TELEGRAM_CHAT_ID ('{os.getenv('TELEGRAM_CHAT_ID')}') не є валідним числом! Перевірте .env файл.")
-    sys.exit(1)
-
-BACKUP_INTERVAL_MINUTES = int(os.getenv('BACKUP_INTERVAL_MINUTES', '5'))
-BOT_CHECK_INTERVAL_MINUTES = int(os.getenv('BOT_CHECK_INTERVAL_MINUTES', '60'))
-BOT_CHECK_START_DELAY_SECONDS = int(os.getenv('BOT_CHECK_START_DELAY_SECONDS', '10'))
-POSE_CHECK_INTERVAL_MINUTES = int(os.getenv('POSE_CHECK_INTERVAL_MINUTES', '3'))
-POSE_CHECK_START_DELAY_SECONDS = int(os.getenv('POSE_CHECK_START_DELAY_SECONDS', '10'))
-KEEP_LOCAL_BACKUPS = int(os.getenv('KEEP_LOCAL_BACKUPS', '10'))
-SESSION_NAME = os.getenv('SESSION_NAME', 'mongodb_backup_userbot')
-POSE_DATA_DIR = os.getenv('POSE_DATA_DIR', './pose_data')
-POSE_API_BASE_URL = os.getenv('POSE_API_BASE_URL', 'http://84.247.168.144:8001')
-POSE_API_TOKEN = os.getenv('POSE_API_TOKEN')
-
-# Прапорець для запобігання паралельного виконання
-backup_in_progress = False
-
-# Створення директорії для бекапів
-Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-Path(POSE_DATA_DIR).mkdir(parents=True, exist_ok=True)
-
-# Змінна для відстеження прогресу відправки
-last_reported_progress = -1
-
-def progress_callback(current, total):
-    """Callback-функція для відображення прогресу відправки."""
-    global last_reported_progress
-    if total == 0:
-        return
 
-    percentage = int((current / total) * 100)
-    if percentage % 10 == 0 and percentage > last_reported_progress:
-        logger.info(f"Відправка в Telegram: {percentage}%")
-        last_reported_progress = percentage
+def _load_config() -> Config:
+    """Зчитує та перевіряє environment variables до створення Telegram клієнта."""
+    required = ('MONGODB_URI', 'TELEGRAM_API_ID', 'TELEGRAM_API_HASH', 'TELEGRAM_CHAT_ID')
+    missing = [name for name in required if not os.getenv(name)]
+    if missing:
+        logger.error(f"Не всі необхідні змінні оточення встановлені: {', '.join(missing)}")
+        sys.exit(1)
+
+    return Config(
+        mongodb_uri=os.getenv('MONGODB_URI'),
+        telegram_api_id=os.getenv('TELEGRAM_API_ID'),
+        telegram_api_hash=os.getenv('TELEGRAM_API_HASH'),
+        telegram_chat_id=_env_int('TELEGRAM_CHAT_ID', 0),
+        backup_dir=os.getenv('BACKUP_DIR', './backups'),
+        backup_interval_minutes=_env_int('BACKUP_INTERVAL_MINUTES', 5),
+        keep_local_backups=_env_int('KEEP_LOCAL_BACKUPS', 10),
+        mongodump_parallel=_env_int('MONGODUMP_PARALLEL', os.cpu_count() or 4),
+        mongodump_exclude=tuple(
+            name.strip() for name in os.getenv('MONGODUMP_EXCLUDE', '').split(',') if name.strip()
+        ),
+        mongodump_read_preference=os.getenv('MONGODUMP_READ_PREFERENCE') or None,
+        session_name=os.getenv('SESSION_NAME', 'mongodb_backup_userbot'),
+        telegram_max_transmissions=_env_int('TELEGRAM_MAX_TRANSMISSIONS', 8),
+        control_api_url=os.getenv(
+            'CONTROL_API_URL',
+            'https://control-api.undresstool.fun/v1/bots/?page=1&page_size=100&show_tokens=true'
+        ),
+        control_api_containers_url=os.getenv(
+            'CONTROL_API_CONTAINERS_URL',
+            'https://control-api.undresstool.fun/v1/system/containers/small'
+        ),
+        control_api_key=os.getenv('CONTROL_API_KEY'),
+        bot_check_interval_minutes=_env_int('BOT_CHECK_INTERVAL_MINUTES', 60),
+        bot_check_start_delay_seconds=_env_int('BOT_CHECK_START_DELAY_SECONDS', 10),
+        pose_check_interval_minutes=_env_int('POSE_CHECK_INTERVAL_MINUTES', 3),
+        pose_check_start_delay_seconds=_env_int('POSE_CHECK_START_DELAY_SECONDS', 10),
+        pose_data_dir=os.getenv('POSE_DATA_DIR', './pose_data'),
+        pose_api_base_url=os.getenv('POSE_API_BASE_URL', 'http://84.247.168.144:8001'),
+        pose_api_token=os.getenv('POSE_API_TOKEN')
+    )
+
+
+# Ліміт часу mongodump, розмір блоку архіву зі stdout та довжина черги блоків
+MONGODUMP_TIMEOUT_SECONDS = 120 * 60
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+ARCHIVE_QUEUE_SIZE = 32
+# Буфер StreamReader для stdout: зі стандартними 64 KiB читання блоками по 1 MiB
+# повертало б лише частини блоку
+ARCHIVE_PIPE_LIMIT = 4 * 1024 * 1024
+# Скільки останніх рядків stderr mongodump тримати для повідомлення про помилку
+STDERR_TAIL_LINES = 8192
+
+# Максимальний розмір архіву в пам'яті, якщо KEEP_LOCAL_BACKUPS=0
+SPOOL_MAX_SIZE = 256 * 1024 * 1024
+
+
+class NamedSpooledTemporaryFile(tempfile.SpooledTemporaryFile):
+    """SpooledTemporaryFile зі сталим .name.
+
+    Pyrogram бере ім'я InputFile з fp.name, а у SpooledTemporaryFile це None
+    (в пам'яті) або fd (після переносу на диск) - відправка падала б після
+    завантаження всього архіву.
+    """
+
+    def __init__(self, name: str, **kwargs):
+        super().__init__(**kwargs)
+        self._upload_name = name
+
+    @property
+    def name(self):
+        return self._upload_name
+
+# Спільна HTTP-сесія (keep-alive) для перевірок ботів і pose endpoints, створюється в main()
+http_session = None
+BOT_CHECK_CONCURRENCY = 25
+HTTP_RETRIES = 2
+HTTP_RETRY_BACKOFF_SECONDS = 0.3
+
+# ETag/Last-Modified для умовних запитів: control API - разом з відповіддю в пам'яті,
+# pose endpoints - у POSE_DATA_DIR/etags.json (їхній стан і так зберігається на диску)
+control_api_cache = {}
+pose_validators = {}
+
+# Повтори відправки в Telegram при FloodWait
+FLOOD_WAIT_RETRIES = 5
+FLOOD_WAIT_MAX_SECONDS = 3600
+
+# Процес для побудови diff pose endpoints, створюється в main()
+diff_pool = None
+
+# Розкид запусків планових задач
+MAX_JOB_JITTER_SECONDS = 60
+STARTUP_JITTER_SECONDS = 30
+
+# Налаштування, зчитані в main() через _load_config()
+config = None
+
+# ID чату після get_chat при старті, щоб Pyrogram брав peer з кешу сесії
+RESOLVED_CHAT_ID = None
+
+# Кільце шляхів локальних бекапів (від найновішого) довжиною KEEP_LOCAL_BACKUPS;
+# BACKUP_DIR сканується лише при старті
+recent_backups = collections.deque()
+
+# Блокування для запобігання паралельного виконання бекапів
+backup_lock = asyncio.Lock()
+
+# Шаблони повідомлень у Telegram
+CAPTION_TMPL = (
+    "📦 MongoDB Backup\n"
+    "📅 Дата: {date}\n"
+    "💾 Розмір: {mb:.2f} MB\n"
+    "⏱ Час створення: {dur:.2f} сек\n"
+    "✅ Статус: Успішно"
+)
+FAILURE_TMPL = "🔥 **Помилка створення бекапу MongoDB** 🔥\n\n**Причина:** {reason}\n{details}"
+FAILURE_DETAILS_TMPL = "\n**Деталі:**\n```\n{details}\n```"
+NOTIFY_MENTIONS = "@Artemka1806 @redditmarketing"
+BAN_TMPL = "🚫 **Боти в бані або токен недійсний**\n\n{bots}{mentions}"
+BAN_LINE_TMPL = "**bot_username:** @{username}, **bot_number:** {number}\n"
+# Запас до ліміту Telegram у 4096 символів на повідомлення
+BAN_MESSAGE_MAX_LENGTH = 3500
+POSE_HDR_TMPL = "🔄 **Зміни в {name}**\n{mentions}"
+
+def make_progress_callback():
+    """Створює callback прогресу відправки зі своїм станом для кожного завантаження."""
+    thresholds = []
+    next_idx = [0]
+
+    def progress_callback(current, total):
+        if not thresholds:
+            if total == 0:
+                return
+            # Межі кожних 10%, рахуються один раз, коли відомий розмір файлу
+            thresholds.extend(total * step // 10 for step in range(1, 11))
+
+        # Прогрес пішов назад - antiflood повторює відправку після FloodWait
+        if next_idx[0] and current < thresholds[next_idx[0] - 1]:
+            next_idx[0] = 0
+
+        if next_idx[0] >= 10 or current < thresholds[next_idx[0]]:
+            return
+        while next_idx[0] < 10 and current >= thresholds[next_idx[0]]:
+            next_idx[0] += 1
+        logger.info("Відправка в Telegram: %d%%", next_idx[0] * 10)
+
+    return progress_callback
 
 
 async def send_failure_notification(app: Client, reason: str, details: str = None):
     """Відправляє повідомлення про помилку в Telegram."""
     try:
         logger.info(f"Відправка повідомлення про помилку: {reason}")
-        message = f"🔥 **Помилка створення бекапу MongoDB** 🔥\n\n"
-        message += f"**Причина:** {reason}\n"
-        
-        if details:
-            details_short = (details[:3500] + '...') if len(details) > 3500 else details
-            message += f"\n**Деталі:**\n```\n{details_short}\n```"
+        # Зберігаємо кінець: у хвості stderr mongodump - остання, головна помилка
+        if details and len(details) > 3500:
+            details = '...' + details[-3500:]
+        message = FAILURE_TMPL.format_map({
+            'reason': reason,
+            'details': FAILURE_DETAILS_TMPL.format_map({'details': details}) if details else ''
+        })
             
-        await app.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
+        await antiflood(
+            app.send_message,
+            chat_id=RESOLVED_CHAT_ID,
             text=message
         )
     except Exception as e:
         logger.error(f"Не вдалося відправити повідомлення про помилку: {e}")
 
 
+async def pipe_archive_to_file(stream: asyncio.StreamReader, archive):
+    """Переливає архів зі stdout mongodump у файл через обмежену чергу блоків.
+
+    Читання pipe і запис на диск йдуть паралельно, тож повільний диск
+    не зупиняє mongodump, поки в черзі є місце.
+    """
+    chunks = asyncio.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+
+    async def read_stdout():
+        while chunk := await stream.read(ARCHIVE_CHUNK_SIZE):
+            await chunks.put(chunk)
+        await chunks.put(None)
+
+    async def write_file():
+        while (chunk := await chunks.get()) is not None:
+            await asyncio.to_thread(archive.write, chunk)
+
+    reader = asyncio.create_task(read_stdout())
+    writer = asyncio.create_task(write_file())
+    try:
+        await asyncio.gather(reader, writer)
+    finally:
+        reader.cancel()
+        writer.cancel()
+
+
+async def drain_stderr(stream: asyncio.StreamReader) -> bytes:
+    """Читає stderr mongodump, зберігаючи лише останні STDERR_TAIL_LINES рядків."""
+    tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Рядок довший за буфер StreamReader: його вже відкинуто, читаємо далі
+            continue
+        if not line:
+            return b"".join(tail)
+        tail.append(line)
+
+
+async def run_mongodump(cmd: list, archive):
+    """Запускає mongodump, записує архів у відкритий файл. Повертає (код виходу, stderr)."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=ARCHIVE_PIPE_LIMIT
+    )
+    # stderr читаємо паралельно, щоб заповнений PIPE не зупинив mongodump
+    stderr_task = asyncio.create_task(drain_stderr(proc.stderr))
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(pipe_archive_to_file(proc.stdout, archive), proc.wait()),
+            timeout=MONGODUMP_TIMEOUT_SECONDS
+        )
+    finally:
+        # Таймаут або скасування задачі при зупинці сервісу - mongodump не має пережити нас
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+            stderr_task.cancel()
+    return proc.returncode, await stderr_task
+
+
+def drop_page_cache(file_path: str):
+    """Просить ядро звільнити сторінковий кеш файлу після відправки."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.warning(f"Не вдалося звільнити кеш для {file_path}: {e}")
+
+
 async def create_backup(app: Client):
     """Створює бекап MongoDB"""
-    global backup_in_progress
-    
-    if backup_in_progress:
+    if backup_lock.locked():
         logger.warning("Бекап вже виконується. Пропускаємо цей запуск.")
         return
     
-    backup_in_progress = True
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    async with backup_lock:
+        await run_backup(app)
+
+
+async def run_backup(app: Client):
+    """Знімає дамп, відправляє його в Telegram та чистить старі бекапи."""
+    started_at = datetime.now()
+    timestamp = started_at.strftime('%Y%m%d_%H%M%S')
     backup_filename = f"mongodb_backup_{timestamp}.gz"
-    backup_path = os.path.join(BACKUP_DIR, backup_filename)
+    backup_path = os.path.join(config.backup_dir, backup_filename)
     
     try:
         logger.info(f"Початок створення бекапу: {backup_filename}")
         
+        # --archive без шляху: mongodump пише архів у stdout.
+        # Стиснення робить вбудований --gzip, повторно архів не стискаємо.
         cmd = [
             'mongodump',
-            f'--uri={MONGODB_URI}',
+            f'--uri={config.mongodb_uri}',
             '--gzip',
-            f'--archive={backup_path}'
+            '--archive',
+            f'--numParallelCollections={config.mongodump_parallel}'
         ]
+        cmd.extend(f'--excludeCollection={name}' for name in config.mongodump_exclude)
+        if config.mongodump_read_preference:
+            # Напр. secondaryPreferred - дамп читається з репліки, а не з primary
+            cmd.append(f'--readPreference={config.mongodump_read_preference}')
         
-        start_time = datetime.now()
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=120 * 60
-        )
-        
-        duration = (datetime.now() - start_time).total_seconds()
-        
-        if result.returncode != 0:
-            error_message = f"Процес mongodump завершився з кодом помилки {result.returncode}."
-            logger.error(f"Помилка при створенні бекапу: {result.stderr}")
-            await send_failure_notification(app, error_message, result.stderr)
-            return
-        
-        file_size = os.path.getsize(backup_path)
-        file_size_mb = file_size / (1024 * 1024)
+        keep_local = config.keep_local_backups > 0
+        if keep_local:
+            archive = open(backup_path, 'wb')
+        else:
+            # Локальні копії не потрібні: архів у пам'яті, на диск лише понад SPOOL_MAX_SIZE
+            archive = NamedSpooledTemporaryFile(backup_filename, max_size=SPOOL_MAX_SIZE, suffix='.gz')
         
-        logger.info(f"Бекап створено успішно. Розмір: {file_size_mb:.2f} MB, Час: {duration:.2f} сек")
+        with archive:
+            returncode, stderr = await run_mongodump(cmd, archive)
+            
+            duration = (datetime.now() - started_at).total_seconds()
+            
+            if returncode != 0:
+                stderr_text = stderr.decode('utf-8', errors='replace')
+                error_message = f"Процес mongodump завершився з кодом помилки {returncode}."
+                logger.error(f"Помилка при створенні бекапу: {stderr_text}")
+                await send_failure_notification(app, error_message, stderr_text)
+                return
+            
+            file_size = archive.tell()
+            file_size_mb = file_size / (1024 * 1024)
+            
+            logger.info(f"Бекап створено успішно. Розмір: {file_size_mb:.2f} MB, Час: {duration:.2f} сек")
+            
+            if not keep_local:
+                archive.seek(0)
+                await send_to_telegram(app, archive, backup_filename, file_size, duration, started_at)
+                return
         
-        await send_to_telegram(app, backup_path, backup_filename, file_size_mb, duration)
+        # Готовий архів реєструється до відправки: якщо задачу скасують під час
+        # завантаження, finally не видалить повний бекап
+        await remember_backup(backup_path)
         
-        cleanup_old_backups()
+        await send_to_telegram(app, backup_path, backup_filename, file_size, duration, started_at)
+        drop_page_cache(backup_path)
         
-    except subprocess.TimeoutExpired as e:
+    except asyncio.TimeoutError:
         error_message = "Таймаут виконання mongodump (перевищено 120 хвилин)."
         logger.error(error_message)
-        await send_failure_notification(app, error_message, str(e))
+        await send_failure_notification(app, error_message)
     except Exception as e:
         error_message = "Несподівана помилка під час створення бекапу."
         logger.error(f"{error_message} {str(e)}", exc_info=True)
         await send_failure_notification(app, error_message, str(e))
     finally:
-        backup_in_progress = False
+        # Невдалий архів не потрапляє в recent_backups, тож кільце його не видалить
+        if backup_path not in recent_backups and os.path.exists(backup_path):
+            os.unlink(backup_path)
 
 
-async def send_to_telegram(app: Client, file_path, filename, file_size_mb, duration):
+async def send_to_telegram(app: Client, file_path, filename, file_size: int, duration, started_at: datetime):
     """Відправляє бекап файл в Telegram"""
-    global last_reported_progress
     try:
         logger.info(f"Відправка файлу в Telegram: {filename}")
-        last_reported_progress = -1
         
-        caption = (
-            f"📦 MongoDB Backup\n"
-            f"📅 Дата: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-            f"💾 Розмір: {file_size_mb:.2f} MB\n"
-            f"⏱ Час створення: {duration:.2f} сек\n"
-            f"✅ Статус: Успішно"
-        )
+        caption = CAPTION_TMPL.format_map({
+            'date': started_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'mb': file_size / (1024 * 1024),
+            'dur': duration
+        })
         
-        await send_document_with_flood_wait(
-            app=app,
-            chat_id=TELEGRAM_CHAT_ID,
+        await antiflood(
+            app.send_document,
+            chat_id=RESOLVED_CHAT_ID,
             document=file_path,
+            file_name=filename,
             caption=caption,
-            progress=progress_callback
+            progress=make_progress_callback()
         )
         
         logger.info("Файл успішно відправлено в Telegram")
@@ -192,99 +467,179 @@ async def send_to_telegram(app: Client, file_path, filename, file_size_mb, durat
         logger.error(f"Помилка при відправці в Telegram: {str(e)}", exc_info=True)
 
 
-async def send_document_with_flood_wait(app: Client, **kwargs):
-    """Надійна відправка документу з очікуванням FloodWait."""
-    while True:
+async def antiflood(func, *args, retries: int = FLOOD_WAIT_RETRIES, **kwargs):
+    """Викликає метод Pyrogram, очікуючи FloodWait рівно e.value сек + невеликий jitter.
+
+    При повторних FloodWait підряд очікування подвоюється (але не більше
+    FLOOD_WAIT_MAX_SECONDS); після retries спроб помилка пробрасується далі.
+    """
+    multiplier = 1
+    for attempt in range(retries + 1):
         try:
-            return await app.send_document(**kwargs)
+            return await func(*args, **kwargs)
         except FloodWait as e:
-            wait_seconds = max(int(getattr(e, "value", 0)), 1)
-            logger.warning(f"FloodWait при відправці файлу, очікування {wait_seconds} сек...")
+            if attempt == retries:
+                raise
+            wait_seconds = min(e.value * multiplier + random.uniform(0, 2), FLOOD_WAIT_MAX_SECONDS)
+            logger.warning(f"FloodWait у {func.__name__}, очікування {wait_seconds:.1f} сек...")
             await asyncio.sleep(wait_seconds)
+            multiplier *= 2
 
-def cleanup_old_backups():
-    """Видаляє старі бекапи, залишаючи лише останні N"""
+
+def scan_backups():
+    """Повертає список (mtime, path, name) локальних бекапів за один прохід os.scandir."""
+    with os.scandir(config.backup_dir) as it:
+        return [
+            (entry.stat().st_mtime, entry.path, entry.name)
+            for entry in it
+            if entry.name.startswith('mongodb_backup_') and entry.name.endswith('.gz')
+            and entry.is_file()
+        ]
+
+
+def load_recent_backups():
+    """Заповнює кільце recent_backups при старті; бекапи понад ліміт видаляються."""
+    global recent_backups
+    paths = [path for _, path, _ in sorted(scan_backups(), reverse=True)]
+    keep = max(config.keep_local_backups, 0)
+    recent_backups = collections.deque(paths[:keep], maxlen=keep)
+    for old_backup in paths[keep:]:
+        remove_backup_file(old_backup)
+
+
+def remove_backup_file(path: str):
     try:
-        backup_files = sorted(
-            Path(BACKUP_DIR).glob('mongodb_backup_*.gz'),
-            key=lambda x: x.stat().st_mtime,
-            reverse=True
-        )
-        
-        if len(backup_files) > KEEP_LOCAL_BACKUPS:
-            for old_backup in backup_files[KEEP_LOCAL_BACKUPS:]:
-                old_backup.unlink()
-                logger.info(f"Видалено старий бекап: {old_backup.name}")
-                
+        os.unlink(path)
+        logger.info(f"Видалено старий бекап: {os.path.basename(path)}")
+    except FileNotFoundError:
+        pass
     except Exception as e:
-        logger.error(f"Помилка при очищенні старих бекапів: {str(e)}")
+        logger.error(f"Помилка при видаленні старого бекапу {path}: {str(e)}")
+
+
+async def remember_backup(path: str):
+    """Додає бекап у кільце; бекап, що з нього випадає, видаляється з диска."""
+    if len(recent_backups) == recent_backups.maxlen:
+        await asyncio.to_thread(remove_backup_file, recent_backups[-1])
+    recent_backups.appendleft(path)
 
 
 async def send_latest_backup_on_startup(app: Client):
     """Знаходить останній бекап і відправляє його при старті."""
-    global last_reported_progress
-    try:
-        logger.info("Перевірка наявності останнього бекапу для відправки...")
-        
-        backup_files = sorted(
-            Path(BACKUP_DIR).glob('mongodb_backup_*.gz'),
-            key=lambda x: x.stat().st_mtime,
-            reverse=True
-        )
+    # Під тим самим блокуванням, що й бекап: запланований дамп не видалить
+    # файл з кільця, поки він відправляється
+    async with backup_lock:
+        try:
+            logger.info("Перевірка наявності останнього бекапу для відправки...")
         
-        if not backup_files:
-            logger.warning("Локальні бекапи не знайдено. Пропускаємо відправку.")
-            await app.send_message(
-                chat_id=TELEGRAM_CHAT_ID,
-                text="🤖 **Бота перезапущено.**\n\n⚠️ Локальні бекапи не знайдено."
-            )
-            return
+            if not recent_backups:
+                logger.warning("Локальні бекапи не знайдено. Пропускаємо відправку.")
+                await antiflood(
+                    app.send_message,
+                    chat_id=RESOLVED_CHAT_ID,
+                    text="🤖 **Бота перезапущено.**\n\n⚠️ Локальні бекапи не знайдено."
+                )
+                return
             
-        latest_backup = backup_files[0]
-        filename = latest_backup.name
+            latest_backup = recent_backups[0]
+            filename = os.path.basename(latest_backup)
         
-        logger.info(f"Знайдено останній бекап: {filename}. Відправка...")
-        last_reported_progress = -1
+            logger.info(f"Знайдено останній бекап: {filename}. Відправка...")
 
-        caption = f"🤖 **Бота перезапущено.**\n\n✅ Останній доступний бекап: `{filename}`"
+            caption = f"🤖 **Бота перезапущено.**\n\n✅ Останній доступний бекап: `{filename}`"
         
-        await send_document_with_flood_wait(
-            app=app,
-            chat_id=TELEGRAM_CHAT_ID,
-            document=str(latest_backup),
-            caption=caption,
-            progress=progress_callback
-        )
+            await antiflood(
+                app.send_document,
+                chat_id=RESOLVED_CHAT_ID,
+                document=latest_backup,
+                caption=caption,
+                progress=make_progress_callback()
+            )
         
-        logger.info("Останній бекап успішно відправлено.")
+            logger.info("Останній бекап успішно відправлено.")
         
-    except Exception as e:
-        logger.error(f"Помилка при відправці останнього бекапу: {str(e)}", exc_info=True)
+        except Exception as e:
+            logger.error(f"Помилка при відправці останнього бекапу: {str(e)}", exc_info=True)
+            try:
+                await antiflood(
+                    app.send_message,
+                    chat_id=RESOLVED_CHAT_ID,
+                    text=f"🤖 **Бота перезапущено.**\n\n❌ Не вдалося відправити останній бекап.\nПомилка: {str(e)}"
+                )
+            except Exception as send_e:
+                logger.error(f"Не вдалося навіть відправити повідомлення про помилку: {send_e}")
+
+
+async def fetch_json(url: str, headers: dict, timeout: int = 10, validators: dict = None, raw: bool = False):
+    """HTTP GET через спільну сесію, повертає (status_code, json_obj, validators).
+
+    З raw=True замість json_obj повертається тіло відповіді як є (bytes).
+
+    validators - ETag/Last-Modified попередньої відповіді: з ними запит умовний,
+    на 304 повертається (304, None, None). На 200 повертаються нові validators -
+    викликач зберігає їх лише після успішної обробки відповіді.
+    """
+    if validators:
+        headers = dict(headers)
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    # Повтори лише на помилках з'єднання: keep-alive з'єднання з пулу сервер міг уже закрити
+    for attempt in range(HTTP_RETRIES + 1):
         try:
-            await app.send_message(
-                chat_id=TELEGRAM_CHAT_ID,
-                text=f"🤖 **Бота перезапущено.**\n\n❌ Не вдалося відправити останній бекап.\nПомилка: {str(e)}"
-            )
-        except Exception as send_e:
-            logger.error(f"Не вдалося навіть відправити повідомлення про помилку: {send_e}")
-
-
-def fetch_json(url: str, headers: dict, timeout: int = 10):
-    """Синхронний HTTP GET, повертає (status_code, json_obj)."""
-    req = urllib.request.Request(url, headers=headers, method="GET")
+            async with http_session.get(
+                url,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status == 304:
+                    return 304, None, None
+                data = await response.read()
+                new_validators = None
+                if response.status == 200:
+                    new_validators = {}
+                    if etag := response.headers.get('ETag'):
+                        new_validators['etag'] = etag
+                    if last_modified := response.headers.get('Last-Modified'):
+                        new_validators['last_modified'] = last_modified
+                if raw:
+                    return response.status, data, new_validators
+                return response.status, json_loads(data) if data else {}, new_validators
+        except aiohttp.ClientConnectionError:
+            if attempt == HTTP_RETRIES:
+                raise
+            await asyncio.sleep(HTTP_RETRY_BACKOFF_SECONDS * 2 ** attempt)
+
+
+async def fetch_json_cached(url: str, headers: dict, timeout: int = 10):
+    """fetch_json з умовним запитом; на 304 повертає попередню відповідь з пам'яті."""
+    entry = control_api_cache.setdefault(url, {'validators': {}, 'payload': None})
+    status, payload, validators = await fetch_json(url, headers, timeout, entry['validators'])
+    if status == 304:
+        return 200, entry['payload']
+    if status == 200:
+        entry['payload'] = payload
+        entry['validators'] = validators
+    return status, payload
+
+
+def pose_validators_path() -> Path:
+    return Path(config.pose_data_dir) / "etags.json"
+
+
+def load_pose_validators():
+    """Зчитує збережені ETag/Last-Modified pose endpoints."""
     try:
-        with urllib.request.urlopen(req, timeout=timeout) as response:
-            status = response.getcode()
-            data = response.read()
-    except urllib.error.HTTPError as e:
-        status = e.code
-        data = e.read()
-    return status, json.loads(data) if data else {}
+        pose_validators.update(json.loads(load_bytes_if_exists(pose_validators_path()) or b"{}"))
+    except ValueError as e:
+        logger.warning(f"Не вдалося прочитати {pose_validators_path()}: {e}")
 
 
 async def check_bots_status(app: Client):
     """Перевіряє доступність ботів та повідомляє про 401."""
-    if not CONTROL_API_KEY:
+    if not config.control_api_key:
         logger.warning(
             "CONTROL_API_KEY не заданий. Додайте його в .env (CONTROL_API_KEY=...). "
             "Перевірку ботів пропущено."
@@ -292,10 +647,9 @@ async def check_bots_status(app: Client):
         return
 
     try:
-        containers_status, containers_payload = await asyncio.to_thread(
-            fetch_json,
-            CONTROL_API_CONTAINERS_URL,
-            {"accept": "application/json", "X-API-Key": CONTROL_API_KEY},
+        containers_status, containers_payload = await fetch_json_cached(
+            config.control_api_containers_url,
+            {"accept": "application/json", "X-API-Key": config.control_api_key},
             15
         )
     except Exception as e:
@@ -325,10 +679,9 @@ async def check_bots_status(app: Client):
 
     try:
         logger.info("Запуск перевірки ботів...")
-        status, payload = await asyncio.to_thread(
-            fetch_json,
-            CONTROL_API_URL,
-            {"accept": "application/json", "X-API-Key": CONTROL_API_KEY},
+        status, payload = await fetch_json_cached(
+            config.control_api_url,
+            {"accept": "application/json", "X-API-Key": config.control_api_key},
             15
         )
     except Exception as e:
@@ -344,145 +697,461 @@ async def check_bots_status(app: Client):
         logger.info("Список ботів порожній.")
         return
 
-    for item in items:
-        token = item.get("bot_token")
-        if not token:
-            continue
-
-        bot_username = item.get("bot_username", "unknown")
-        bot_number = item.get("bot_number", "unknown")
-        container_name = f"bot{bot_number}"
-        if container_name not in container_names:
-            continue
-
-        try:
-            status, payload = await asyncio.to_thread(
-                fetch_json,
-                f"https://api.telegram.org/bot{token}/getMyName",
-                {"accept": "application/json"},
-                10
-            )
-        except Exception as e:
-            logger.error(f"Помилка при getMyName для {bot_username}: {e}")
-            continue
+    semaphore = asyncio.Semaphore(BOT_CHECK_CONCURRENCY)
+    banned = []
 
-        if status == 401 or payload.get("ok") is False:
-            message = (
-                "🚫 **Бот в бані або токен недійсний**\n\n"
-                f"**bot_username:** @{bot_username}\n"
-                f"**bot_number:** {bot_number}\n"
-                "@Artemka1806 @redditmarketing"
-            )
+    async def check_bot(token: str, bot_username: str, bot_number):
+        async with semaphore:
             try:
-                await app.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+                status, payload, _ = await fetch_json(
+                    f"https://api.telegram.org/bot{token}/getMyName",
+                    {"accept": "application/json"},
+                    10
+                )
             except Exception as e:
-                logger.error(f"Не вдалося відправити повідомлення про бан: {e}")
+                logger.error(f"Помилка при getMyName для {bot_username}: {e}")
+                return
+
+        if status == 401 or payload.get("ok") is False:
+            banned.append((bot_username, bot_number))
         elif status != 200:
             logger.warning(f"Неочікуваний статус getMyName для {bot_username}: {status}")
 
+    # Лише боти з токеном і запущеним контейнером botN
+    worklist = [
+        (item["bot_token"], item.get("bot_username", "unknown"), item.get("bot_number", "unknown"))
+        for item in items
+        if item.get("bot_token") and f"bot{item.get('bot_number', 'unknown')}" in container_names
+    ]
+
+    # Запити до api.telegram.org йдуть паралельно через keep-alive пул спільної сесії;
+    # TaskGroup скасовує всі перевірки разом із задачею при зупинці сервісу
+    async with asyncio.TaskGroup() as tg:
+        for work in worklist:
+            tg.create_task(check_bot(*work))
+
+    if not banned:
+        return
+
+    # Зведені повідомлення за цикл замість окремого на кожного бота
+    for message in build_ban_messages(banned):
+        try:
+            await antiflood(app.send_message, chat_id=RESOLVED_CHAT_ID, text=message)
+        except Exception as e:
+            logger.error(f"Не вдалося відправити повідомлення про бан: {e}")
+
+
+def build_ban_messages(banned: list) -> list:
+    """Розбиває список забанених ботів на повідомлення не довші за BAN_MESSAGE_MAX_LENGTH."""
+    overhead = len(BAN_TMPL.format_map({'bots': '', 'mentions': NOTIFY_MENTIONS}))
+    messages = []
+    lines = []
+    length = overhead
+    for bot_username, bot_number in banned:
+        line = BAN_LINE_TMPL.format_map({'username': bot_username, 'number': bot_number})
+        if lines and length + len(line) > BAN_MESSAGE_MAX_LENGTH:
+            messages.append(BAN_TMPL.format_map({'bots': "".join(lines), 'mentions': NOTIFY_MENTIONS}))
+            lines = []
+            length = overhead
+        lines.append(line)
+        length += len(line)
+    if lines:
+        messages.append(BAN_TMPL.format_map({'bots': "".join(lines), 'mentions': NOTIFY_MENTIONS}))
+    return messages
+
+
+# orjson перетворює цілі понад 64 біти на float; дані з такими числами
+# (19+ цифр поспіль) розбирає стандартний json
+LONG_NUMBER_RE = re.compile(rb'\d{19}')
+
+
+def json_loads(data: bytes):
+    """Розбір JSON через orjson, якщо він встановлений і не втратить точність."""
+    if orjson is not None and not LONG_NUMBER_RE.search(data):
+        return orjson.loads(data)
+    return json.loads(data)
+
 
 def normalize_json(data) -> str:
     """Стабільний текстовий формат JSON для порівняння."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, option=orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2).decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass
     return json.dumps(data, ensure_ascii=False, sort_keys=True, indent=2)
 
 
-def load_text_if_exists(path: Path) -> str:
+def canonical_json(data) -> bytes:
+    """Компактний канонічний JSON для хешування та збереження стану.
+
+    Завжди стандартний json: orjson інакше форматує float (1e16 проти 1e+16)
+    і не серіалізує цілі понад 64 біти, тож хеші залежали б від його наявності.
+    """
+    return json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def payload_hash(canonical: bytes) -> str:
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+def load_bytes_if_exists(path: Path) -> bytes:
     if path.exists():
-        return path.read_text(encoding="utf-8")
-    return ""
+        return path.read_bytes()
+    return b""
+
+
+def atomic_write_bytes(path: Path, data: bytes):
+    """Записує файл атомарно: тимчасовий файл, fsync, os.replace."""
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# Файл стану: {"hash":"<32 hex>","payload":<канонічний JSON>}
+POSE_STATE_PREFIX = b'{"hash":"'
+POSE_HASH_HEX_LEN = 32
+POSE_HASH_RE = re.compile(rb'[0-9a-f]{%d}' % POSE_HASH_HEX_LEN)
+POSE_PAYLOAD_SEP = b'","payload":'
+
+
+def load_pose_state(path: Path):
+    """Повертає (hash, сирі байти) збереженого стану або None, якщо стану немає чи він пошкоджений.
+
+    Хеш читається з початку файлу, тож payload розбирається лише коли потрібен diff.
+    """
+    data = load_bytes_if_exists(path)
+    if not data:
+        return None
+    if data.startswith(POSE_STATE_PREFIX):
+        start = len(POSE_STATE_PREFIX)
+        end = start + POSE_HASH_HEX_LEN
+        digest = data[start:end]
+        if POSE_HASH_RE.fullmatch(digest) and data.startswith(POSE_PAYLOAD_SEP, end) and data.endswith(b'}'):
+            return digest.decode('ascii'), data
+        # Пошкоджений файл вважається відсутнім і перезаписується поточним станом
+        logger.warning(f"Пошкоджений файл стану {path.name}, його буде перезаписано")
+        return None
+    # Старий формат (у файлі лише сам payload) одразу переписується в новий,
+    # щоб наступні перевірки порівнювали лише хеш
+    try:
+        canonical = canonical_json(json_loads(data))
+    except ValueError:
+        logger.warning(f"Пошкоджений файл стану {path.name}, його буде перезаписано")
+        return None
+    digest = payload_hash(canonical)
+    data = pose_state_bytes(digest, canonical)
+    atomic_write_bytes(path, data)
+    return digest, data
+
+
+def pose_state_payload(data: bytes):
+    state = json_loads(data)
+    return state["payload"] if data.startswith(POSE_STATE_PREFIX) else state
+
+
+def pose_state_bytes(digest: str, canonical: bytes) -> bytes:
+    return POSE_STATE_PREFIX + digest.encode('ascii') + POSE_PAYLOAD_SEP + canonical + b'}'
+
+
+def save_pose_state(path: Path, digest: str, canonical: bytes):
+    atomic_write_bytes(path, pose_state_bytes(digest, canonical))
+
+
+def structural_diff(old, new, path: str = "$") -> list:
+    """Рядки змін між двома JSON-значеннями: + додано, - видалено, ~ змінено.
+
+    Списки об'єктів з унікальним "id" порівнюються за id, інші списки - як
+    множини елементів, тож перестановка елементів змін не дає.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        return diff_mappings(old, new, lambda key: f"{path}.{key}")
+
+    if isinstance(old, list) and isinstance(new, list):
+        old_by_id, new_by_id = index_by_id(old), index_by_id(new)
+        if old_by_id is not None and new_by_id is not None:
+            return diff_mappings(old_by_id, new_by_id, lambda key: f"{path}[id={key}]")
+
+        old_items = [compact_json(item) for item in old]
+        new_items = [compact_json(item) for item in new]
+        old_set, new_set = set(old_items), set(new_items)
+        return (
+            [f"- {path}[]: {item}" for item in old_items if item not in new_set]
+            + [f"+ {path}[]: {item}" for item in new_items if item not in old_set]
+        )
+
+    if old != new:
+        return [f"~ {path}: {compact_json(old)} -> {compact_json(new)}"]
+    return []
+
+
+def diff_mappings(old: dict, new: dict, child_path) -> list:
+    lines = []
+    for key in sorted(old.keys() | new.keys()):
+        if key not in new:
+            lines.append(f"- {child_path(key)}: {compact_json(old[key])}")
+        elif key not in old:
+            lines.append(f"+ {child_path(key)}: {compact_json(new[key])}")
+        else:
+            lines.extend(structural_diff(old[key], new[key], child_path(key)))
+    return lines
+
+
+def compact_json(value) -> str:
+    return json.dumps(value, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+
+
+def index_by_id(items: list):
+    """Словник {id: item}, якщо всі елементи - об'єкти з унікальним "id", інакше None."""
+    if not all(isinstance(item, dict) and "id" in item for item in items):
+        return None
+    by_id = {str(item["id"]): item for item in items}
+    return by_id if len(by_id) == len(items) else None
+
+
+def hash_pose_response(body: bytes):
+    """Канонічні байти відповіді та їх хеш.
+
+    Виконується в diff_pool: у процес передаються сирі байти відповіді,
+    розбір і серіалізація відбуваються вже там.
+    """
+    canonical = canonical_json(json_loads(body) if body else {})
+    return canonical, payload_hash(canonical)
+
+
+def detect_pose_change(name: str, data_path: Path, canonical: bytes, digest: str):
+    """Порівнює хеш payload зі збереженим станом.
+
+    Повертає None, якщо змін немає (початковий стан одразу зберігається),
+    інакше попередній стан (сирі байти) для побудови diff.
+    """
+    previous = load_pose_state(data_path)
+
+    if previous is None:
+        save_pose_state(data_path, digest, canonical)
+        logger.info(f"Збережено початковий стан для {name}")
+        return None
+
+    previous_hash, previous_data = previous
+    if previous_hash == digest:
+        return None
+    return previous_data
+
+
+def compute_pose_diff(name: str, previous_data: bytes, canonical: bytes) -> str | None:
+    """Текст змін між попереднім і новим станом; None, якщо попередній стан не розбирається.
+
+    Виконується в diff_pool: приймає лише байти (дешево передати в процес)
+    і не пише в лог та на диск.
+    """
+    try:
+        previous_payload = pose_state_payload(previous_data)
+    except (ValueError, KeyError, TypeError):
+        return None
+    payload = json_loads(canonical)
+    diff_lines = structural_diff(previous_payload, payload)
+    if not diff_lines:
+        # Зміни, які структурний diff не показує (напр. дублікати в списках)
+        diff_lines = difflib.unified_diff(
+            normalize_json(previous_payload).splitlines(),
+            normalize_json(payload).splitlines(),
+            fromfile=f"{name}_prev",
+            tofile=f"{name}_new",
+            lineterm=""
+        )
+    return "\n".join(diff_lines)
+
+
+def create_diff_pool():
+    # forkserver: fork процесу з потоками (QueueListener, to_thread, Pyrogram) небезпечний;
+    # сервер форків лише імпортує модуль, а логування і потоки стартують тільки в __main__
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=1,
+        mp_context=multiprocessing.get_context('forkserver')
+    )
+
+
+async def run_in_diff_pool(func, *args):
+    """Виконує func у diff_pool.
+
+    Якщо процес упав (напр. OOM на великому payload), пул створюється заново і
+    виклик повторюється один раз. У головному процесі ця робота не виконується:
+    після другого падіння помилка пробрасується, і цикл для endpoint пропускається.
+    """
+    global diff_pool
+    for attempt in range(2):
+        pool = diff_pool
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except concurrent.futures.BrokenExecutor:
+            logger.warning("Процес diff_pool аварійно завершився, створюємо новий пул")
+            if diff_pool is pool:
+                pool.shutdown(wait=False)
+                diff_pool = create_diff_pool()
+            if attempt == 1:
+                raise
 
 
 async def check_pose_endpoints(app: Client):
     """Перевіряє зміни у pose endpoints та повідомляє в чат."""
-    if not POSE_API_TOKEN:
+    if not config.pose_api_token:
         logger.warning(
             "POSE_API_TOKEN не заданий. Додайте його в .env (POSE_API_TOKEN=...). "
             "Перевірку поз пропущено."
         )
         return
 
-    headers = {"accept": "application/json", "access-token": POSE_API_TOKEN}
+    headers = {"accept": "application/json", "access-token": config.pose_api_token}
     endpoints = {
-        "video_all_poses": f"{POSE_API_BASE_URL}/video/all_poses",
-        "pose_poses": f"{POSE_API_BASE_URL}/pose/poses",
+        "video_all_poses": f"{config.pose_api_base_url}/video/all_poses",
+        "pose_poses": f"{config.pose_api_base_url}/pose/poses",
     }
 
+    validators_before = json.dumps(pose_validators, sort_keys=True)
+
+    requests = []
     for name, url in endpoints.items():
-        try:
-            status, payload = await asyncio.to_thread(fetch_json, url, headers, 15)
-        except Exception as e:
-            logger.error(f"Помилка при запиті {name}: {e}")
+        data_path = Path(config.pose_data_dir) / f"{name}.json"
+        # Без збереженого стану 304 нема з чим порівнювати - потрібна повна відповідь
+        validators = pose_validators.get(url) if data_path.exists() else None
+        requests.append((name, url, data_path, fetch_json(url, headers, 15, validators, raw=True)))
+
+    results = await asyncio.gather(*(request for *_, request in requests), return_exceptions=True)
+
+    for (name, url, data_path, _), result in zip(requests, results):
+        if isinstance(result, Exception):
+            logger.error(f"Помилка при запиті {name}: {result}")
+            continue
+
+        status, body, new_validators = result
+        if status == 304:
             continue
 
         if status != 200:
             logger.error(f"Невдалий статус {status} для {name}")
             continue
 
-        normalized = normalize_json(payload)
-        data_path = Path(POSE_DATA_DIR) / f"{name}.json"
-        previous = load_text_if_exists(data_path)
-
-        if not previous:
-            data_path.write_text(normalized, encoding="utf-8")
-            logger.info(f"Збережено початковий стан для {name}")
+        try:
+            await process_pose_payload(app, name, data_path, body)
+        except Exception as e:
+            # Ні ETag, ні стан не оновлюються: наступний цикл отримає повну відповідь
+            # і знову повідомить про зміну
+            logger.error(f"Помилка при обробці {name}: {e}", exc_info=True)
             continue
+        pose_validators[url] = new_validators
 
-        if previous == normalized:
-            continue
+    validators_after = json.dumps(pose_validators, sort_keys=True)
+    if validators_after != validators_before:
+        await asyncio.to_thread(atomic_write_bytes, pose_validators_path(), validators_after.encode('utf-8'))
 
-        diff_lines = difflib.unified_diff(
-            previous.splitlines(),
-            normalized.splitlines(),
-            fromfile=f"{name}_prev",
-            tofile=f"{name}_new",
-            lineterm=""
+
+async def process_pose_payload(app: Client, name: str, data_path: Path, body: bytes):
+    """Порівнює тіло відповіді зі збереженим станом, надсилає diff і зберігає новий стан.
+
+    Стан зберігається лише після успішної відправки: якщо вона впала, наступний
+    цикл знову побачить зміну і повідомить про неї.
+    """
+    # Розбір, серіалізація, хеш і diff - в окремому процесі: json і difflib тримають GIL
+    # і гальмували б event loop навіть з потоку. Між процесами ходять лише байти.
+    # Читання і запис стану - у потоці.
+    canonical, digest = await run_in_diff_pool(hash_pose_response, body)
+    previous_data = await asyncio.to_thread(detect_pose_change, name, data_path, canonical, digest)
+    if previous_data is None:
+        return
+    diff_text = await run_in_diff_pool(compute_pose_diff, name, previous_data, canonical)
+    if diff_text is None:
+        logger.warning(f"Не вдалося розібрати збережений стан {name}, його буде перезаписано")
+        await asyncio.to_thread(save_pose_state, data_path, digest, canonical)
+        return
+
+    header = POSE_HDR_TMPL.format_map({'name': name, 'mentions': NOTIFY_MENTIONS})
+    if len(diff_text) > 3500:
+        diff_file = Path(config.pose_data_dir) / f"{name}_diff_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        await asyncio.to_thread(diff_file.write_text, diff_text, encoding="utf-8")
+        await antiflood(
+            app.send_document,
+            chat_id=RESOLVED_CHAT_ID,
+            document=str(diff_file),
+            caption=header
         )
-        diff_text = "\n".join(diff_lines)
-        data_path.write_text(normalized, encoding="utf-8")
-
-        header = f"🔄 **Зміни в {name}**\n@Artemka1806 @redditmarketing"
-        if len(diff_text) > 3500:
-            diff_file = Path(POSE_DATA_DIR) / f"{name}_diff_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-            diff_file.write_text(diff_text, encoding="utf-8")
-            await send_document_with_flood_wait(
-                app=app,
-                chat_id=TELEGRAM_CHAT_ID,
-                document=str(diff_file),
-                caption=header
-            )
-        else:
-            message = f"{header}\n\n```\n{diff_text}\n```"
-            await app.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+    else:
+        message = f"{header}\n\n```\n{diff_text}\n```"
+        await antiflood(app.send_message, chat_id=RESOLVED_CHAT_ID, text=message)
+
+    await asyncio.to_thread(save_pose_state, data_path, digest, canonical)
+
+
+def interval_job_options(interval_minutes: int, start_delay_seconds: int = None) -> dict:
+    """Тригер з jitter і misfire_grace_time, щоб задачі не збігалися в один тік.
+
+    Якщо задано start_delay_seconds, перший запуск зсувається ще на
+    випадкові 0..STARTUP_JITTER_SECONDS секунд.
+    """
+    interval_seconds = interval_minutes * 60
+    options = {
+        'trigger': IntervalTrigger(
+            minutes=interval_minutes,
+            jitter=min(MAX_JOB_JITTER_SECONDS, interval_seconds // 10)
+        ),
+        'misfire_grace_time': interval_seconds
+    }
+    if start_delay_seconds is not None:
+        delay = start_delay_seconds + random.randint(0, STARTUP_JITTER_SECONDS)
+        options['next_run_time'] = datetime.now() + timedelta(seconds=delay)
+    return options
 
 
 async def main():
     """Головна функція"""
+    global config, RESOLVED_CHAT_ID, http_session, diff_pool
+    config = _load_config()
+
+    # Створення директорії для бекапів
+    Path(config.backup_dir).mkdir(parents=True, exist_ok=True)
+    Path(config.pose_data_dir).mkdir(parents=True, exist_ok=True)
+    load_recent_backups()
+    load_pose_validators()
+
     logger.info("=" * 50)
     logger.info("Запуск MongoDB Backup Service (USER BOT)")
-    logger.info(f"Інтервал бекапів: {BACKUP_INTERVAL_MINUTES} хвилин")
-    logger.info(f"Директорія бекапів: {BACKUP_DIR}")
-    logger.info(f"Зберігати локально: {KEEP_LOCAL_BACKUPS} бекапів")
+    logger.info(f"Інтервал бекапів: {config.backup_interval_minutes} хвилин")
+    logger.info(f"Директорія бекапів: {config.backup_dir}")
+    logger.info(f"Зберігати локально: {config.keep_local_backups} бекапів")
     logger.info("=" * 50)
-    
-    if not all([MONGODB_URI, TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_CHAT_ID]):
-        logger.error("Не всі необхідні змінні оточення встановлені!")
-        sys.exit(1)
+
 
     app = Client(
-        SESSION_NAME,
-        api_id=TELEGRAM_API_ID,
-        api_hash=TELEGRAM_API_HASH,
-        workdir="./sessions"
+        config.session_name,
+        api_id=config.telegram_api_id,
+        api_hash=config.telegram_api_hash,
+        workdir="./sessions",
+        # Ліміт одночасних файлових передач, а не потоків однієї відправки
+        max_concurrent_transmissions=config.telegram_max_transmissions
+    )
+
+    # Усі задачі - корутини, тож достатньо AsyncIOExecutor без пулу потоків
+    scheduler = AsyncIOScheduler(
+        executors={'default': AsyncIOExecutor()},
+        job_defaults={'coalesce': True, 'max_instances': 1}
     )
 
-    scheduler = AsyncIOScheduler()
+    stop_event = asyncio.Event()
 
-    def signal_handler(signum, frame):
+    def signal_handler():
         logger.info("Отримано сигнал завершення, зупиняємо процеси...")
-        sys.exit(0)
+        stop_event.set()
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, signal_handler)
+    loop.add_signal_handler(signal.SIGTERM, signal_handler)
+
+    http_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=50, ttl_dns_cache=300, keepalive_timeout=60)
+    )
+    diff_pool = create_diff_pool()
 
     try:
         await app.start()
@@ -492,72 +1161,69 @@ async def main():
         logger.info(f"Авторизовано як: {me.first_name} (@{me.username if me.username else 'без username'})")
         logger.info(f"ID: {me.id}, Phone: {me.phone_number if me.phone_number else 'N/A'}")
 
-        chat = await app.get_chat(TELEGRAM_CHAT_ID)
+        # get_me/get_chat викликаються лише тут; запланові задачі їх не повторюють.
+        # resolve_peer одразу кладе InputPeer чату в кеш сесії для подальших відправок.
+        chat = await app.get_chat(config.telegram_chat_id)
+        RESOLVED_CHAT_ID = chat.id
+        await app.resolve_peer(RESOLVED_CHAT_ID)
         logger.info(f"Resolved chat id: {chat.id}, type: {type(chat).__name__}")
 
         # await send_latest_backup_on_startup(app)
         
-        job = functools.partial(create_backup, app)
+        async def backup_tick():
+            # Перевірка на рівні event loop: тік під час активного бекапу одразу завершується
+            if backup_lock.locked():
+                logger.debug("Пропуск тіку - бекап ще виконується")
+                return
+            await create_backup(app)
+
         scheduler.add_job(
-            job,
-            trigger=IntervalTrigger(minutes=BACKUP_INTERVAL_MINUTES),
+            backup_tick,
             id='backup_job',
             name='MongoDB Backup Job',
             replace_existing=True,
-            max_instances=1
+            **interval_job_options(config.backup_interval_minutes)
         )
 
         bot_check_job = functools.partial(check_bots_status, app)
         scheduler.add_job(
             bot_check_job,
-            trigger=IntervalTrigger(minutes=BOT_CHECK_INTERVAL_MINUTES),
             id='bot_check_job',
             name='Bot Availability Check Job',
             replace_existing=True,
-            max_instances=1
+            **interval_job_options(
+                config.bot_check_interval_minutes,
+                config.bot_check_start_delay_seconds
+            )
         )
 
         pose_check_job = functools.partial(check_pose_endpoints, app)
         scheduler.add_job(
             pose_check_job,
-            trigger=IntervalTrigger(minutes=POSE_CHECK_INTERVAL_MINUTES),
             id='pose_check_job',
             name='Pose Endpoints Check Job',
             replace_existing=True,
-            max_instances=1
+            **interval_job_options(
+                config.pose_check_interval_minutes,
+                config.pose_check_start_delay_seconds
+            )
         )
 
         scheduler.start()
         logger.info("Scheduler запущено")
 
         logger.info(
-            "Перевірка ботів запланована кожні %s хвилин",
-            BOT_CHECK_INTERVAL_MINUTES
+            "Перевірка ботів запланована кожні %s хвилин, перший запуск через ~%s сек",
+            config.bot_check_interval_minutes,
+            config.bot_check_start_delay_seconds
         )
-
-        if BOT_CHECK_START_DELAY_SECONDS > 0:
-            logger.info(
-                "Перший запуск перевірки ботів через %s сек",
-                BOT_CHECK_START_DELAY_SECONDS
-            )
-            await asyncio.sleep(BOT_CHECK_START_DELAY_SECONDS)
-        await check_bots_status(app)
-
         logger.info(
-            "Перевірка pose endpoints запланована кожні %s хвилин",
-            POSE_CHECK_INTERVAL_MINUTES
+            "Перевірка pose endpoints запланована кожні %s хвилин, перший запуск через ~%s сек",
+            config.pose_check_interval_minutes,
+            config.pose_check_start_delay_seconds
         )
-
-        if POSE_CHECK_START_DELAY_SECONDS > 0:
-            logger.info(
-                "Перший запуск перевірки pose endpoints через %s сек",
-                POSE_CHECK_START_DELAY_SECONDS
-            )
-            await asyncio.sleep(POSE_CHECK_START_DELAY_SECONDS)
-        await check_pose_endpoints(app)
         
-        while True:
-            await asyncio.sleep(3600)
+        await stop_event.wait()
             
     except asyncio.CancelledError:
         logger.info("Головна задача була скасована.")
@@ -569,8 +1235,17 @@ async def main():
         if app.is_initialized:
             await app.stop()
             logger.info("Telegram клієнт зупинено.")
+        await http_session.close()
+        diff_pool.shutdown(wait=False, cancel_futures=True)
         logger.info("Сервіс повністю зупинено.")
 
 
 if __name__ == "__main__":
+    load_dotenv()
+    setup_logging()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     asyncio.run(main())